@@ -1,10 +1,13 @@
 from __future__ import annotations
 import os
 import logging
+import math
+import pickle
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 from pathlib import Path
-from dotenv import load_dotenv
+import orjson
 from threading import Thread
 
 # Import Flask for the keep-alive web server
@@ -14,11 +17,12 @@ from telegram import Update
 from telegram.ext import (
     Application,
     ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
-    PicklePersistence,
+    PersistenceInput,
 )
 
 # --------------------------- Web Server Keep-Alive ---------------------------
@@ -37,17 +41,44 @@ def run_web_server():
     flask_app.run(host="0.0.0.0", port=port)
 
 # --------------------------- Config & State ---------------------------
-# The bot's state will now be persisted by the PicklePersistence layer
-# to this file, instead of manual JSON reads/writes.
-STATE_FILE = Path("bot_state.pkl")
+# The bot's state is persisted as JSON by the JSONPersistence layer to this
+# file. The old pickle file is only read once, if the JSON file is missing.
+STATE_FILE = Path("bot_state.json")
+LEGACY_STATE_FILE = Path("bot_state.pkl")
 ALLOWED_BUCKETS = ("Aditya", "Archit")
+# bucket name -> index into ALLOWED_BUCKETS, for names saved by older versions
+BUCKET_INDEX = {name: i for i, name in enumerate(ALLOWED_BUCKETS)}
+# lowercased bucket name -> index, for matching names typed in commands
+BUCKET_ALIASES = {name.lower(): i for i, name in enumerate(ALLOWED_BUCKETS)}
 DEFAULT_MILEAGE = 40.0  # km per liter
-
-# Load environment variables from .env file
-load_dotenv()
-TOKEN = os.getenv("TELEGRAM_TOKEN", "")
-if not TOKEN:
-    raise SystemExit("Missing TELEGRAM_TOKEN in environment (.env)")
+# Bump this when the saved State layout changes and add a step to migrate_state()
+STATE_SCHEMA_VERSION = 2
+PERSISTENCE_INTERVAL = 60  # seconds between state writes to disk (PTB's default)
+CONCURRENT_UPDATES = 32  # max updates processed at the same time
+
+# --------------------------- Messages ---------------------------
+# Fixed replies are built once at import time instead of on every command.
+HELP_TEXT = (
+    "Hi! This bot splits fuel fairly using liter buckets.\n\n"
+    "1) `/register Aditya` or `/register Archit`\n"
+    "2) Start a ride: `/ride_start <odo_km>`\n"
+    "3) End the ride: `/ride_end <odo_km>` (auto computes liters)\n"
+    "4) When you refuel: `/fill <liters> <total_cost_rs>`\n"
+    "5) Adjust mileage: `/set_mileage <km_per_liter>`\n"
+    "6) Check status: `/status`\n"
+    "7) Settle up: `/settle` and `/pay <amount|full>`\n"
+    "8) Import past rides: `/replay <name>,<km> ...`\n"
+    "9) Reset data: `/reset`"
+)
+NOT_REGISTERED_TEXT = "You're not registered yet. Use /register Aditya OR /register Archit"
+USAGE_REGISTER = "Usage: /register <Aditya|Archit>"
+INVALID_BUCKET_TEXT = f"Invalid bucket. Use one of: {', '.join(ALLOWED_BUCKETS)}"
+USAGE_RIDE_START = "Usage: /ride_start <odometer_km>"
+USAGE_REPLAY = (
+    "Usage: /replay <name>,<km> [<name>,<km> ...]\n"
+    "One entry per past ride, e.g. /replay Aditya,12.5 Archit,30"
+)
+UNKNOWN_TEXT = "Sorry, I didn't understand that command. Try /help"
 
 # Set up basic logging
 logging.basicConfig(
@@ -56,22 +87,190 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True)
 class State:
     """
     A dataclass to hold the entire state of the bot.
     This object will be stored in context.bot_data by the persistence layer.
+    Ride start readings are short-lived, so they live in (unpersisted)
+    context.user_data instead.
+    Updates are processed concurrently, but all handlers run on one event loop
+    and change the state without awaiting in between, so no locks are needed.
+    Keep any new read-modify-write on the state free of awaits.
     """
-    # map telegram user id -> bucket name ("Aditya" or "Archit")
-    users: Dict[str, str] = field(default_factory=dict)
-    # liters each bucket currently has contributed/available
-    tank: Dict[str, float] = field(default_factory=lambda: {b: 0.0 for b in ALLOWED_BUCKETS})
-    # how many liters each bucket owes to the *other* bucket
-    debt: Dict[str, float] = field(default_factory=lambda: {b: 0.0 for b in ALLOWED_BUCKETS})
-    # temporary ride start readings per telegram user id
-    ride_start: Dict[str, float] = field(default_factory=dict)
+    # map telegram user id -> bucket index into ALLOWED_BUCKETS (0 or 1)
+    users: Dict[int, int] = field(default_factory=dict)
+    # liters each bucket currently has contributed/available, indexed by bucket
+    tank: List[float] = field(default_factory=lambda: [0.0] * len(ALLOWED_BUCKETS))
+    # how many liters each bucket owes to the *other* bucket, indexed by bucket
+    debt: List[float] = field(default_factory=lambda: [0.0] * len(ALLOWED_BUCKETS))
     mileage: float = DEFAULT_MILEAGE
+    # 1 / mileage, kept in sync by /set_mileage so rides multiply instead of divide
+    inv_mileage: float = 1.0 / DEFAULT_MILEAGE
     last_price_per_liter: float = 0.0
+    # layout version of the saved state, see migrate_state()
+    version: int = STATE_SCHEMA_VERSION
+
+def is_finite_number(value: Any) -> bool:
+    """True for an int or float that is not nan or inf (None counts as invalid)."""
+    return isinstance(value, (int, float)) and math.isfinite(value)
+
+def repair_state(state: State) -> bool:
+    """
+    Replaces numbers that aren't finite (nan, inf, or null read from JSON):
+    tanks, debts and the price become 0 and an unusable mileage becomes
+    DEFAULT_MILEAGE. inv_mileage is always recomputed from the mileage.
+    Returns True if any invalid number was replaced.
+    """
+    changed = False
+    for values in (state.tank, state.debt):
+        for i, value in enumerate(values):
+            if not is_finite_number(value):
+                values[i] = 0.0
+                changed = True
+    if not is_finite_number(state.last_price_per_liter):
+        state.last_price_per_liter = 0.0
+        changed = True
+    if not (is_finite_number(state.mileage) and state.mileage > 0 and math.isfinite(1.0 / state.mileage)):
+        state.mileage = DEFAULT_MILEAGE
+        changed = True
+    state.inv_mileage = 1.0 / state.mileage
+    return changed
+
+def migrate_state(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Upgrades saved state fields from an older schema version to
+    STATE_SCHEMA_VERSION. Only runs for files written by older versions.
+    """
+    data = dict(data)
+    version = data.get('version', 0)
+    if version < 2:
+        # Unversioned files may predate newer fields, keyed tank/debt and user
+        # buckets by name, and carried the ride_start readings. Non-finite
+        # numbers they may hold are fixed by repair_state() in state_from_dict().
+        for key in ('tank', 'debt'):
+            if isinstance(data.get(key), dict): data[key] = [data[key].get(b, 0.0) for b in ALLOWED_BUCKETS]
+        data['users'] = {
+            uid: BUCKET_INDEX[b] if isinstance(b, str) else b
+            for uid, b in data.get('users', {}).items()
+        }
+        data.pop('ride_start', None)
+    data['version'] = STATE_SCHEMA_VERSION
+    return data
+
+def state_from_dict(data: Dict[str, Any]) -> State:
+    """Builds a State from its saved fields, migrating older schema versions first."""
+    migrated = data.get('version', 0) < STATE_SCHEMA_VERSION
+    if migrated:
+        data = migrate_state(data)
+    state = State(**data)
+    # The old bot accepted nan/inf input (e.g. /set_mileage inf), so legacy
+    # files can hold numbers that can't be saved as JSON.
+    if migrated and repair_state(state):
+        logger.warning("Replaced non-finite numbers in migrated state: %s", state)
+    # User ids are always strings on disk since JSON only has string keys
+    state.users = {int(uid): b for uid, b in state.users.items()}
+    return state
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """Reads the old PicklePersistence file, loading State objects as plain attribute bags."""
+    def find_class(self, module: str, name: str) -> Any:
+        if name == "State":
+            return SimpleNamespace
+        return super().find_class(module, name)
+
+class JSONPersistence(BasePersistence):
+    """
+    Persists the State in bot_data as a JSON file using orjson.
+    Only bot_data is stored; user, chat and callback data are not persisted.
+    If the JSON file doesn't exist yet, the state is imported once from the
+    old PicklePersistence file at legacy_filepath.
+    """
+    def __init__(self, filepath: Path, legacy_filepath: Optional[Path] = None, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(user_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.filepath = filepath
+        self.legacy_filepath = legacy_filepath
+        self._last_written: Optional[bytes] = None
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        if self.filepath.exists():
+            data = orjson.loads(self.filepath.read_bytes())
+        elif self.legacy_filepath is not None and self.legacy_filepath.exists():
+            logger.info("Importing state from %s", self.legacy_filepath)
+            with self.legacy_filepath.open("rb") as file:
+                legacy_state = _LegacyUnpickler(file).load()["bot_data"].get('state')
+            if legacy_state is None:
+                return {}
+            data = vars(legacy_state)
+        else:
+            return {}
+        return {'state': state_from_dict(data)}
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        state = data.get('state')
+        if state is None:
+            return
+        # orjson would write nan/inf as null, which can't be loaded back as a
+        # float. Handlers reject such values, but if one slips through, fix the
+        # live state and keep saving rather than stop persisting altogether.
+        if repair_state(state):
+            logger.error("Replaced non-finite numbers in state before saving: %s", state)
+        payload = orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS)
+        # The application hands us bot_data on every interval; skip unchanged state
+        if payload == self._last_written:
+            return
+        # Write to a temporary file first so a crash can't leave a half-written state
+        tmp_path = self.filepath.with_suffix(".tmp")
+        tmp_path.write_bytes(payload)
+        tmp_path.replace(self.filepath)
+        self._last_written = payload
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass  # every update_bot_data call is already written to disk
+
+    # Nothing below is persisted, see store_data in __init__.
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
 
 # --------------------------- Helpers ---------------------------
 
@@ -79,73 +278,110 @@ def get_state(context: ContextTypes.DEFAULT_TYPE) -> State:
     """Helper to retrieve the state object from bot_data."""
     return context.bot_data['state']
 
-def user_id(update: Update) -> str:
-    """Returns the effective user's ID as a string."""
-    return str(update.effective_user.id)
+def parse_float(text: str) -> float:
+    """Parses a number typed by the user, rejecting nan and inf with ValueError."""
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f"not a finite number: {text}")
+    return value
 
-def user_bucket(uid: str, state: State) -> Optional[str]:
-    """Gets the bucket name for a given user ID."""
+def user_id(update: Update) -> int:
+    """Returns the effective user's ID."""
+    return update.effective_user.id
+
+def user_bucket(uid: int, state: State) -> Optional[int]:
+    """Gets the bucket index for a given user ID."""
     return state.users.get(uid)
 
-def other_bucket(bucket: str) -> str:
-    """Gets the name of the other bucket."""
-    return ALLOWED_BUCKETS[1] if bucket == ALLOWED_BUCKETS[0] else ALLOWED_BUCKETS[0]
+def other_bucket(bucket: int) -> int:
+    """Gets the index of the other bucket."""
+    return 1 - bucket
 
-async def require_registered(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+def consume_fuel(tank: List[float], debt: List[float], me: int, used_l: float) -> float:
     """
-    A decorator-like function that checks if a user is registered.
-    If not, it sends a reply and returns None. Otherwise, returns the user's bucket.
+    Deducts used_l from bucket me, borrowing from the other bucket if needed.
+    The caller must have checked that both tanks together hold enough fuel.
+    Returns the liters borrowed.
     """
-    state = get_state(context)
-    bucket = user_bucket(user_id(update), state)
-    if not bucket:
-        await update.effective_message.reply_text(
-            "You're not registered yet. Use /register Aditya OR /register Archit"
-        )
-        return None
+    if tank[me] >= used_l:
+        tank[me] -= used_l
+        return 0.0
+    other = other_bucket(me)
+    borrowed = used_l - tank[me]
+    tank[me] = 0.0
+    tank[other] -= borrowed
+    debt[me] += borrowed  # "me" now owes "other" this many liters
+    return borrowed
+
+def replay_rides(
+    tank: List[float], debt: List[float], rides: Sequence[Tuple[int, float]], inv_mileage: float
+) -> Tuple[List[float], List[float]]:
+    """
+    Applies a batch of (bucket, distance_km) rides the same way /ride_end does.
+    Works on copies and returns the new (tank, debt), so nothing changes if a
+    ride runs out of fuel; in that case a ValueError names the failing ride.
+    """
+    tank, debt = list(tank), list(debt)
+    for n, (me, distance) in enumerate(rides, 1):
+        used_l = distance * inv_mileage
+        # Written as "not <=" so a NaN usage fails the check instead of passing it
+        if not used_l <= tank[0] + tank[1] + 1e-9:
+            raise ValueError(f"Ride {n} needs {used_l:.2f} L, but only {tank[0] + tank[1]:.2f} L is left.")
+        consume_fuel(tank, debt, me, used_l)
+    return tank, debt
+
+def resolve_bucket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    """
+    Returns the user's bucket index, or None if the user isn't registered.
+    This is a plain function so registered users don't pay for a coroutine;
+    handlers reply with NOT_REGISTERED_TEXT themselves when it returns None.
+    """
+    # The bucket is cached in the user's own user_data after the first lookup,
+    # so most updates never touch the shared State.users mapping.
+    bucket = context.user_data.get('bucket')
+    if bucket is None:
+        bucket = user_bucket(user_id(update), get_state(context))
+        if bucket is not None:
+            context.user_data['bucket'] = bucket
     return bucket
 
 # --------------------------- Commands ---------------------------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /start and /help commands."""
-    await update.message.reply_text(
-        "Hi! This bot splits fuel fairly using liter buckets.\n\n"
-        "1) `/register Aditya` or `/register Archit`\n"
-        "2) Start a ride: `/ride_start <odo_km>`\n"
-        "3) End the ride: `/ride_end <odo_km>` (auto computes liters)\n"
-        "4) When you refuel: `/fill <liters> <total_cost_rs>`\n"
-        "5) Adjust mileage: `/set_mileage <km_per_liter>`\n"
-        "6) Check status: `/status`\n"
-        "7) Settle up: `/settle` and `/pay <amount|full>`\n"
-        "8) Reset data: `/reset`"
-    )
+    await update.message.reply_text(HELP_TEXT)
 
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Registers a user to a bucket (Aditya or Archit)."""
     try:
-        bucket = context.args[0].strip().title()
+        raw = context.args[0].strip().lower()
     except IndexError:
-        await update.message.reply_text("Usage: /register <Aditya|Archit>")
+        await update.message.reply_text(USAGE_REGISTER)
         return
 
-    if bucket not in ALLOWED_BUCKETS:
-        await update.message.reply_text(f"Invalid bucket. Use one of: {', '.join(ALLOWED_BUCKETS)}")
+    bucket = BUCKET_ALIASES.get(raw)
+    if bucket is None:
+        await update.message.reply_text(INVALID_BUCKET_TEXT)
         return
 
     state = get_state(context)
     uid = user_id(update)
     state.users[uid] = bucket
+    context.user_data['bucket'] = bucket
     # No .save() needed! Persistence handles it.
-    await update.message.reply_text(f"Registered you as {bucket}.")
+    await update.message.reply_text(f"Registered you as {ALLOWED_BUCKETS[bucket]}.")
 
 async def set_mileage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Sets the vehicle's mileage."""
-    if not await require_registered(update, context):
+    if resolve_bucket(update, context) is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
     try:
-        kmpl = float(context.args[0])
-        if kmpl <= 0:
+        kmpl = parse_float(context.args[0])
+        inv_mileage = 1.0 / kmpl if kmpl > 0 else math.inf
+        # Rides multiply by 1 / mileage, so a tiny mileage whose reciprocal
+        # overflows to inf would turn every later ride into nan.
+        if not math.isfinite(inv_mileage):
             raise ValueError
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /set_mileage <km_per_liter>, e.g. /set_mileage 40")
@@ -153,90 +389,117 @@ async def set_mileage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     state = get_state(context)
     state.mileage = kmpl
+    state.inv_mileage = inv_mileage
     await update.message.reply_text(f"Mileage set to {kmpl:.2f} km/L.")
 
 async def ride_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Records the starting odometer reading for a ride."""
-    if not await require_registered(update, context):
+    if resolve_bucket(update, context) is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
     try:
-        start_km = float(context.args[0])
+        start_km = parse_float(context.args[0])
     except (IndexError, ValueError):
-        await update.message.reply_text("Usage: /ride_start <odometer_km>")
+        await update.message.reply_text(USAGE_RIDE_START)
         return
     
-    state = get_state(context)
-    state.ride_start[user_id(update)] = start_km
+    context.user_data['ride_start'] = start_km
     await update.message.reply_text(f"Ride started at {start_km} km.")
 
 async def ride_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Records the ending odometer reading and calculates fuel used."""
-    bucket = await require_registered(update, context)
-    if not bucket:
+    bucket = resolve_bucket(update, context)
+    if bucket is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
 
-    state = get_state(context)
-    uid = user_id(update)
-    
-    if uid not in state.ride_start:
+    if 'ride_start' not in context.user_data:
         await update.message.reply_text("You haven't started a ride. Use /ride_start first.")
         return
 
     try:
-        end_km = float(context.args[0])
+        end_km = parse_float(context.args[0])
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /ride_end <odometer_km>")
         return
 
-    start_km = state.ride_start.pop(uid)
+    # The start reading is only removed once the ride is accepted, so an
+    # invalid /ride_end leaves it in place for a corrected retry.
+    start_km = context.user_data['ride_start']
     distance = end_km - start_km
     if distance < 0:
         await update.message.reply_text("End odometer reading can't be less than the start.")
-        # Put the start reading back since the ride was invalid
-        state.ride_start[uid] = start_km
         return
 
-    if state.mileage <= 0:
-        await update.message.reply_text("Cannot calculate usage: mileage is not set to a positive number.")
-        return
-        
-    used_l = distance / state.mileage
+    state = get_state(context)
+    # mileage is always positive (enforced by /set_mileage), so no zero check
+    used_l = distance * state.inv_mileage
     me, other = bucket, other_bucket(bucket)
 
     # Check if there's enough fuel in total across both tanks
     available_total = state.tank[me] + state.tank[other]
-    if used_l > available_total + 1e-9: # Add tolerance for float precision
+    # Add tolerance for float precision; written as "not <=" so a nan usage is rejected
+    if not used_l <= available_total + 1e-9:
         await update.message.reply_text(
             f"Not enough fuel! Ride needs {used_l:.2f} L, but only {available_total:.2f} L is available in total.\n"
             "Please /fill the tank or correct the /set_mileage."
         )
-        state.ride_start[uid] = start_km # Put start reading back
         return
 
+    del context.user_data['ride_start']
     # Deduct from the user's bucket first, then borrow from the other
-    borrowed = 0.0
-    if state.tank[me] >= used_l:
-        state.tank[me] -= used_l
-    else:
-        borrowed = used_l - state.tank[me]
-        state.tank[me] = 0.0
-        state.tank[other] -= borrowed
-        state.debt[me] += borrowed  # "me" now owes "other" this many liters
+    borrowed = consume_fuel(state.tank, state.debt, me, used_l)
 
     await update.message.reply_text(
         f"Ride of {distance:.2f} km ended.\n"
         f"Fuel used: {used_l:.2f} L.\n"
-        f"Borrowed {borrowed:.2f} L from {other}'s bucket."
+        f"Borrowed {borrowed:.2f} L from {ALLOWED_BUCKETS[other]}'s bucket."
+    )
+
+async def replay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Imports a batch of past rides given as <name>,<km> pairs."""
+    if resolve_bucket(update, context) is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
+        return
+    if not context.args:
+        await update.message.reply_text(USAGE_REPLAY)
+        return
+
+    rides = []
+    for arg in context.args:
+        try:
+            name, km = arg.split(",")
+            bucket = BUCKET_ALIASES[name.strip().lower()]
+            distance = parse_float(km)
+            if distance < 0:
+                raise ValueError
+        except (KeyError, ValueError):
+            await update.message.reply_text(f"Invalid ride '{arg}'.\n{USAGE_REPLAY}")
+            return
+        rides.append((bucket, distance))
+
+    state = get_state(context)
+    try:
+        state.tank, state.debt = replay_rides(state.tank, state.debt, rides, state.inv_mileage)
+    except ValueError as e:
+        await update.message.reply_text(f"Nothing imported. {e}")
+        return
+
+    total_km = sum(distance for _, distance in rides)
+    await update.message.reply_text(
+        f"Imported {len(rides)} rides ({total_km:.2f} km, {total_km * state.inv_mileage:.2f} L).\n"
+        "Use /status to see the updated buckets."
     )
 
 async def fill(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Records a fuel fill-up, updating tanks and debts."""
-    bucket = await require_registered(update, context)
-    if not bucket:
+    bucket = resolve_bucket(update, context)
+    if bucket is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
     try:
-        liters = float(context.args[0])
-        total_cost = float(context.args[1])
+        liters = parse_float(context.args[0])
+        total_cost = parse_float(context.args[1])
         if liters <= 0 or total_cost <= 0:
             raise ValueError
     except (IndexError, ValueError):
@@ -245,63 +508,76 @@ async def fill(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     state = get_state(context)
     price = total_cost / liters
-    state.last_price_per_liter = price
     other = other_bucket(bucket)
     
-    # The person filling up first uses the fuel to clear their own debt
+    # The person filling up first uses the fuel to clear their own debt,
+    # and the cleared liters are returned to the other person's tank.
+    # Any remaining fuel goes into the filler's own tank.
     clear_l = min(liters, state.debt[bucket])
-    if clear_l > 0:
-        state.debt[bucket] -= clear_l
-        # The cleared liters are returned to the other person's tank
-        state.tank[other] += clear_l
-    
     remaining_liters = liters - clear_l
-    # Any remaining fuel goes into the filler's own tank
-    state.tank[bucket] += remaining_liters
+    new_other_tank = state.tank[other] + clear_l
+    new_own_tank = state.tank[bucket] + remaining_liters
+    # Finite input can still overflow (e.g. /fill 1e-300 1e300), and a nan
+    # or inf in the state could not be saved, so refuse it up front.
+    if not all(map(math.isfinite, (price, new_other_tank, new_own_tank))):
+        await update.message.reply_text("Those numbers are out of range. Check the liters and total cost.")
+        return
+
+    state.last_price_per_liter = price
+    state.debt[bucket] -= clear_l
+    state.tank[other] = new_other_tank
+    state.tank[bucket] = new_own_tank
 
     await update.message.reply_text(
         f"Fill recorded.\n"
-        f"{clear_l:.2f} L used to clear your debt to {other}.\n"
+        f"{clear_l:.2f} L used to clear your debt to {ALLOWED_BUCKETS[other]}.\n"
         f"{remaining_liters:.2f} L added to your bucket.\n"
         f"New price set to ₹{price:.2f}/L."
     )
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Displays the current status of tanks and debts."""
-    bucket = await require_registered(update, context)
-    if not bucket:
+    bucket = resolve_bucket(update, context)
+    if bucket is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
     
     state = get_state(context)
     me, other = bucket, other_bucket(bucket)
+    # Bind everything the reply needs to locals once
+    tank, debt = state.tank, state.debt
+    price = state.last_price_per_liter
     
-    # Determine who owes whom
-    debt_msg = "All square!"
-    if state.debt[me] > state.debt[other]:
-        net_debt_l = state.debt[me] - state.debt[other]
-        net_debt_rs = net_debt_l * state.last_price_per_liter
-        debt_msg = f"You ({me}) owe {other} {net_debt_l:.2f} L (≈ ₹{net_debt_rs:.2f})."
-    elif state.debt[other] > state.debt[me]:
-        net_debt_l = state.debt[other] - state.debt[me]
-        net_debt_rs = net_debt_l * state.last_price_per_liter
-        debt_msg = f"{other} owes you ({me}) {net_debt_l:.2f} L (≈ ₹{net_debt_rs:.2f})."
-
-    text = (
-        f"--- *Fuel Status* ---\n"
-        f"Tank ({ALLOWED_BUCKETS[0]}): {state.tank[ALLOWED_BUCKETS[0]]:.2f} L\n"
-        f"Tank ({ALLOWED_BUCKETS[1]}): {state.tank[ALLOWED_BUCKETS[1]]:.2f} L\n\n"
-        f"--- *Debt Status* ---\n"
-        f"{debt_msg}\n\n"
-        f"--- *Settings* ---\n"
-        f"Mileage: {state.mileage:.2f} km/L\n"
-        f"Last Fuel Price: ₹{state.last_price_per_liter:.2f}/L"
-    )
+    # Determine who owes whom from the net debt; positive means "me" owes.
+    # The tolerance keeps float residue from showing up as a tiny debt.
+    delta = debt[me] - debt[other]
+    if delta > 1e-9:
+        debt_msg = f"You ({ALLOWED_BUCKETS[me]}) owe {ALLOWED_BUCKETS[other]} {delta:.2f} L (≈ ₹{delta * price:.2f})."
+    elif delta < -1e-9:
+        delta = -delta
+        debt_msg = f"{ALLOWED_BUCKETS[other]} owes you ({ALLOWED_BUCKETS[me]}) {delta:.2f} L (≈ ₹{delta * price:.2f})."
+    else:
+        debt_msg = "All square!"
+
+    text = "\n".join((
+        "--- *Fuel Status* ---",
+        f"Tank ({ALLOWED_BUCKETS[0]}): {tank[0]:.2f} L",
+        f"Tank ({ALLOWED_BUCKETS[1]}): {tank[1]:.2f} L",
+        "",
+        "--- *Debt Status* ---",
+        debt_msg,
+        "",
+        "--- *Settings* ---",
+        f"Mileage: {state.mileage:.2f} km/L",
+        f"Last Fuel Price: ₹{price:.2f}/L",
+    ))
     await update.message.reply_text(text)
 
 async def settle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Calculates and shows the cash value of the user's debt."""
-    bucket = await require_registered(update, context)
-    if not bucket:
+    bucket = resolve_bucket(update, context)
+    if bucket is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
         
     state = get_state(context)
@@ -322,8 +598,9 @@ async def settle(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Pays off debt, either fully or by a specific cash amount."""
-    bucket = await require_registered(update, context)
-    if not bucket:
+    bucket = resolve_bucket(update, context)
+    if bucket is None:
+        await update.message.reply_text(NOT_REGISTERED_TEXT)
         return
     try:
         arg = context.args[0].strip().lower()
@@ -347,7 +624,7 @@ async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        amount = float(arg)
+        amount = parse_float(arg)
         if amount <= 0:
             raise ValueError
     except ValueError:
@@ -388,11 +665,39 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     context.bot_data['state'] = State()  # create a new default state
+    # Drop every user's cached bucket and open ride so nobody stays registered
+    for data in context.application.user_data.values():
+        data.clear()
     await update.message.reply_text("Bot state has been reset. All data cleared!")
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles any unknown commands."""
-    await update.message.reply_text("Sorry, I didn't understand that command. Try /help")
+    await update.message.reply_text(UNKNOWN_TEXT)
+
+# Maps each command name to its handler. A single CommandHandler routes all
+# of them through dispatch() with one dict lookup.
+COMMANDS = {
+    "start": start,
+    "help": start, # Alias /help to /start
+    "register": register,
+    "set_mileage": set_mileage,
+    "ride_start": ride_start,
+    "ride_end": ride_end,
+    "replay": replay,
+    "fill": fill,
+    "status": status,
+    "settle": settle,
+    "pay": pay,
+    "reset": reset,
+}
+
+async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Routes a command to its handler in COMMANDS."""
+    # CommandHandler guarantees the message starts with a bot_command entity;
+    # slice by its length like CommandHandler does, since "/status," is valid.
+    message = update.effective_message
+    command = message.text[1:message.entities[0].length].split("@", 1)[0].lower()
+    await COMMANDS[command](update, context)
 
 # --------------------------- Entry point ---------------------------
 
@@ -404,48 +709,50 @@ async def post_init(application: Application):
         logger.info("Initializing new state...")
         application.bot_data['state'] = State()
     else:
+        # Older state files are converted by state_from_dict() while loading.
         logger.info("Loaded existing state from persistence file.")
-        # This part ensures that if we add new fields to the State dataclass,
-        # old persistence files are gracefully updated.
-        loaded_state = application.bot_data['state']
-        if not hasattr(loaded_state, 'users'): loaded_state.users = {}
-        if not hasattr(loaded_state, 'tank'): loaded_state.tank = {b: 0.0 for b in ALLOWED_BUCKETS}
-        if not hasattr(loaded_state, 'debt'): loaded_state.debt = {b: 0.0 for b in ALLOWED_BUCKETS}
-        if not hasattr(loaded_state, 'ride_start'): loaded_state.ride_start = {}
-        if not hasattr(loaded_state, 'mileage'): loaded_state.mileage = DEFAULT_MILEAGE
-        if not hasattr(loaded_state, 'last_price_per_liter'): loaded_state.last_price_per_liter = 0.0
-
 
 def main():
     """Sets up the bot, the web server, and starts everything."""
+    # Load environment variables from .env file, if python-dotenv is installed.
+    # This happens here rather than at import so importing main.py stays cheap.
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    token = os.environ.get("TELEGRAM_TOKEN", "")
+    if not token:
+        raise SystemExit("Missing TELEGRAM_TOKEN in environment (.env)")
+
     # Start the Flask web server in a daemon thread
     web_thread = Thread(target=run_web_server)
     web_thread.daemon = True
     web_thread.start()
     
-    # We use PicklePersistence to save the bot's state.
-    persistence = PicklePersistence(filepath=STATE_FILE)
+    # We use JSONPersistence to save the bot's state. Changes are written to
+    # disk in batches every PERSISTENCE_INTERVAL seconds, not per command.
+    # Only bot_data is durable; user_data just holds caches and open rides.
+    persistence = JSONPersistence(
+        filepath=STATE_FILE,
+        legacy_filepath=LEGACY_STATE_FILE,
+        update_interval=PERSISTENCE_INTERVAL,
+    )
 
     app = (
         ApplicationBuilder()
-        .token(TOKEN)
+        .token(token)
         .persistence(persistence)
         .post_init(post_init) # Run our setup function on start
+        # Handle updates from different users concurrently instead of one at a time.
+        # Each handler finishes its state changes before its first await, so
+        # concurrent handlers never interleave halfway through an update.
+        .concurrent_updates(CONCURRENT_UPDATES)
         .build()
     )
 
-    # Add command handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", start)) # Alias /help to /start
-    app.add_handler(CommandHandler("register", register))
-    app.add_handler(CommandHandler("set_mileage", set_mileage))
-    app.add_handler(CommandHandler("ride_start", ride_start))
-    app.add_handler(CommandHandler("ride_end", ride_end))
-    app.add_handler(CommandHandler("fill", fill))
-    app.add_handler(CommandHandler("status", status))
-    app.add_handler(CommandHandler("settle", settle))
-    app.add_handler(CommandHandler("pay", pay))
-    app.add_handler(CommandHandler("reset", reset))
+    # Add one command handler for every command in the dispatch table
+    app.add_handler(CommandHandler(list(COMMANDS), dispatch))
 
     # Add a handler for any command that wasn't recognized
     app.add_handler(MessageHandler(filters.COMMAND, unknown))